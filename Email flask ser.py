@@ -1,26 +1,61 @@
 import os
 import sys
 import re
-import json
 import time
+import random
+import socket
+import queue
+import sched
 import smtplib
 import logging
+import functools
+import threading
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
 from datetime import datetime
 from email.mime.text import MIMEText
 from flask import Flask, request, jsonify
+from flask.json.provider import DefaultJSONProvider
 from google.oauth2.service_account import Credentials
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+from gunicorn.app.base import BaseApplication
 
 # ── ENV ────────────────────────────────────────────────────────────────────────
-EMAIL_ADDRESS = os.getenv('EMAIL_ADDRESS')
-EMAIL_PASSWORD = os.getenv('EMAIL_PASSWORD')
-SPREADSHEET_ID = os.getenv('SPREADSHEET_ID')
-SHEET_NAME = os.getenv('SHEET_NAME')
-SHEET_ID = int(os.getenv('SHEET_ID', '0'))
-GOOGLE_CREDENTIALS_FILE = os.getenv('GOOGLE_CREDENTIALS_FILE')  # JSON строкой
-TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
-WEBHOOK_TOKEN = os.getenv('WEBHOOK_TOKEN')
+class Cfg:
+    """Настройки из окружения; читаются и проверяются один раз при старте."""
+    __slots__ = ('email', 'password', 'ss_id', 'sheet_name', 'sheet_id',
+                 'creds_json', 'tg_token', 'webhook_token', 'public_url',
+                 'batch_rows')
+
+    def __init__(self, env=os.environ):
+        self.email = env.get('EMAIL_ADDRESS')
+        self.password = env.get('EMAIL_PASSWORD')
+        self.ss_id = env.get('SPREADSHEET_ID')
+        self.sheet_name = env.get('SHEET_NAME')
+        self.sheet_id = int(env.get('SHEET_ID', '0'))
+        self.creds_json = env.get('GOOGLE_CREDENTIALS_FILE')  # JSON строкой
+        self.tg_token = env.get('TELEGRAM_BOT_TOKEN')
+        self.webhook_token = env.get('WEBHOOK_TOKEN')        # необязательно
+        self.public_url = env.get('PUBLIC_URL')              # необязательно, для setWebhook
+        self.batch_rows = int(env.get('BATCH_ROWS', '50'))   # строк за один триггер
+
+        required = {
+            'EMAIL_ADDRESS': self.email,
+            'EMAIL_PASSWORD': self.password,
+            'SPREADSHEET_ID': self.ss_id,
+            'SHEET_NAME': self.sheet_name,
+            'GOOGLE_CREDENTIALS_FILE': self.creds_json,
+            'TELEGRAM_BOT_TOKEN': self.tg_token,
+        }
+        missing = [name for name, value in required.items() if not value]
+        if missing:
+            raise RuntimeError(f"Не заданы переменные окружения: {', '.join(missing)}")
+        if self.batch_rows < 1:
+            raise RuntimeError(f"BATCH_ROWS должен быть не меньше 1, задано: {self.batch_rows}")
+
+CFG = Cfg()
 
 # ── Логи ───────────────────────────────────────────────────────────────────────
 sys.stdout.reconfigure(encoding='utf-8')
@@ -31,133 +66,454 @@ logging.basicConfig(
     handlers=[logging.StreamHandler(sys.stdout)]
 )
 
+class OrJSONProvider(DefaultJSONProvider):
+    """JSON для Flask (вебхук и ответы) через orjson."""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 app = Flask(__name__)
+app.json = OrJSONProvider(app)
+
+# ── Повторы с экспоненциальной задержкой ──────────────────────────────────────
+_RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+def _is_retryable(e: Exception, idempotent: bool) -> bool:
+    if isinstance(e, HttpError):
+        status = e.resp.status
+    elif isinstance(e, requests.HTTPError) and e.response is not None:
+        status = e.response.status_code
+    elif isinstance(e, requests.ConnectTimeout):
+        return True  # соединение не установлено — запрос точно не ушёл
+    else:
+        # обрыв соединения: запрос мог и дойти, повторяем только безопасные
+        return idempotent and isinstance(e, (
+            requests.ConnectionError, requests.Timeout,
+            smtplib.SMTPServerDisconnected, ConnectionError, socket.timeout,
+        ))
+    # 429 — запрос точно не выполнен; 5xx — только для идемпотентных
+    return status == 429 or (idempotent and status in _RETRY_STATUSES)
+
+def _retry_after(e: Exception):
+    resp = getattr(e, "response", None)
+    value = resp.headers.get("Retry-After") if resp is not None else None
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+def _retry(fn, *, attempts=5, base=0.5, cap=30.0, idempotent=True):
+    """fn() с повторами на временных ошибках: full jitter, потолок cap секунд."""
+    for i in range(attempts):
+        try:
+            return fn()
+        except Exception as e:
+            if i == attempts - 1 or not _is_retryable(e, idempotent):
+                raise
+            delay = _retry_after(e)
+            if delay is None:
+                delay = random.uniform(0, min(cap, base * (2 ** i)))
+            elif delay > cap:
+                raise  # flood-wait дольше cap — не держим поток, сдаёмся
+            logging.info(f"🔁 Повтор через {delay:.1f} с ({i + 1}/{attempts - 1}): {e}")
+            time.sleep(delay)
 
 # ── Google Sheets ──────────────────────────────────────────────────────────────
+# Ключ сервисного аккаунта разбираем один раз при старте: битый JSON
+# роняет процесс сразу, а не на первом вебхуке
+_SCOPES = [
+    'https://www.googleapis.com/auth/spreadsheets',
+    'https://www.googleapis.com/auth/drive'
+]
+_CREDS_DICT = orjson.loads(CFG.creds_json)
+_CREDS = Credentials.from_service_account_info(_CREDS_DICT, scopes=_SCOPES)
+
 def build_sheets_service():
-    creds_dict = json.loads(GOOGLE_CREDENTIALS_FILE)
-    creds = Credentials.from_service_account_info(
-        creds_dict,
-        scopes=[
-            'https://www.googleapis.com/auth/spreadsheets',
-            'https://www.googleapis.com/auth/drive'
-        ]
-    )
-    return build('sheets', 'v4', credentials=creds)
+    # static_discovery: документ Sheets v4 берётся из пакета, без HTTP-запроса
+    return build('sheets', 'v4', credentials=_CREDS,
+                 cache_discovery=False, static_discovery=True)
+
+_SHEETS_SERVICE = None
+_SHEETS_LOCK = threading.Lock()
+# Готовые методы ресурсов: spreadsheets()/values() каждый раз строят новый Resource
+_VALUES_GET = None
+_BATCH_UPDATE = None
+
+def get_sheets_service():
+    """Один и тот же service на весь процесс (ленивая инициализация)."""
+    global _SHEETS_SERVICE, _VALUES_GET, _BATCH_UPDATE
+    if _SHEETS_SERVICE is None:
+        with _SHEETS_LOCK:
+            if _SHEETS_SERVICE is None:
+                service = build_sheets_service()
+                sheets = service.spreadsheets()
+                _VALUES_GET = sheets.values().get
+                _BATCH_UPDATE = sheets.batchUpdate
+                _SHEETS_SERVICE = service
+    return _SHEETS_SERVICE
 
 # ── Telegram ───────────────────────────────────────────────────────────────────
+# Одна keep-alive сессия на процесс: TLS до api.telegram.org — один раз.
+# Повторы — только через _retry, без второго слоя в адаптере.
+_TG_API = f"https://api.telegram.org/bot{CFG.tg_token}"
+_SEND_URL = f"{_TG_API}/sendMessage"
+_SET_WEBHOOK_URL = f"{_TG_API}/setWebhook"
+
+_TG = requests.Session()
+_TG.headers.update({"Connection": "keep-alive"})
+_TG.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8))
+
+def _tg_post(url: str, **kwargs):
+    """POST в Bot API; 429/5xx поднимаются как HTTPError, чтобы _retry повторил."""
+    resp = _TG.post(url, **kwargs)
+    if resp.status_code in _RETRY_STATUSES:
+        raise requests.HTTPError(f"{resp.status_code}: {resp.text}", response=resp)
+    return resp
+
 def tg_send(chat_id: int, text: str):
     try:
-        url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
-        resp = requests.post(url, data={"chat_id": chat_id, "text": text, "parse_mode": "Markdown"}, timeout=10)
+        # sendMessage не идемпотентен: после 5xx/обрыва сообщение могло уйти
+        resp = _retry(lambda: _tg_post(_SEND_URL, data={"chat_id": chat_id, "text": text, "parse_mode": "Markdown"}, timeout=10),
+                      idempotent=False)
         if resp.status_code != 200:
             logging.info(f"⚠️ Telegram send failed: {resp.text}")
     except Exception as e:
         logging.info(f"⚠️ Ошибка при отправке в Telegram: {e}")
 
+def tg_set_webhook():
+    """Регистрирует /webhook у Telegram — апдейты приходят push'ем, без опроса."""
+    url = f"{CFG.public_url.rstrip('/')}/webhook"
+    if CFG.webhook_token:
+        url += f"?token={CFG.webhook_token}"
+    try:
+        resp = _retry(lambda: _tg_post(
+            _SET_WEBHOOK_URL,
+            json={"url": url, "allowed_updates": ["message"], "max_connections": 40},
+            timeout=10,
+        ))
+        if resp.status_code != 200:
+            logging.info(f"⚠️ Telegram setWebhook failed: {resp.text}")
+        else:
+            logging.info("🔗 Webhook зарегистрирован в Telegram.")
+    except Exception as e:
+        logging.info(f"⚠️ Ошибка при регистрации webhook: {e}")
+
 # ── SMTP: классификация ошибок ────────────────────────────────────────────────
+_SMTP_CODE_RE = re.compile(r'5\.\d+\.\d+')
+_CODE_MAP = {
+    "5.5.2": "пустая строка",
+    "5.1.3": "неправильный адрес",
+}
+
 def classify_error(error: Exception) -> str:
     s = str(error)
-    m = re.search(r'5\.\d+\.\d+', s)
+    m = _SMTP_CODE_RE.search(s)
     if m:
-        code = m.group()
-        if code == "5.5.2":
-            return "пустая строка"
-        if code == "5.1.3":
-            return "неправильный адрес"
+        return _CODE_MAP.get(m.group(), s)
     return s  # всё остальное — полный текст
 
 # ── Email ─────────────────────────────────────────────────────────────────────
+SMTP_MAX_MESSAGES = 100   # после стольких писем переподключаемся
+SMTP_KEEPALIVE_SEC = 60   # как часто пингуем сервер NOOP'ом
+
+_SMTP = None
+_SMTP_SENT = 0
+_SMTP_LOCK = threading.Lock()
+
+def _smtp_close():
+    global _SMTP
+    if _SMTP is not None:
+        try:
+            _SMTP.quit()
+        except Exception:
+            pass
+    _SMTP = None
+
+def _smtp_connect():
+    global _SMTP, _SMTP_SENT
+    _smtp_close()
+    server = smtplib.SMTP_SSL('smtp.gmail.com', 465, timeout=30)
+    server.login(CFG.email, CFG.password)
+    _SMTP, _SMTP_SENT = server, 0
+    logging.info("🔌 SMTP-соединение установлено.")
+    return server
+
+def get_smtp():
+    """Живое SMTP_SSL-соединение; вызывать под _SMTP_LOCK."""
+    if _SMTP is None or _SMTP_SENT >= SMTP_MAX_MESSAGES:
+        return _smtp_connect()
+    try:
+        _SMTP.noop()
+    except Exception:
+        return _smtp_connect()
+    return _SMTP
+
+def _smtp_keepalive():
+    while True:
+        time.sleep(SMTP_KEEPALIVE_SEC)
+        with _SMTP_LOCK:
+            if _SMTP is None:
+                continue
+            try:
+                _SMTP.noop()
+            except Exception:
+                _smtp_close()
+
 def send_email(to_email: str, subject: str, html_content: str):
+    global _SMTP_SENT
     logging.info(f"📧 Отправка письма на: {to_email}")
+    # Заведомо плохой адрес SMTP всё равно отклонит (5.5.2 / 5.1.3) —
+    # не собираем MIME и не ходим на сервер
+    to_email = to_email or ""
+    if "@" not in to_email:
+        err = _CODE_MAP["5.5.2"] if not to_email else _CODE_MAP["5.1.3"]
+        logging.info(f"❌ Письмо не отправлено: {err}")
+        return False, err
     msg = MIMEText(html_content or "", 'html')
     msg['Subject'] = subject or ""
-    msg['From'] = EMAIL_ADDRESS
-    msg['To'] = to_email or ""
+    msg['From'] = CFG.email
+    msg['To'] = to_email
     try:
-        with smtplib.SMTP_SSL('smtp.gmail.com', 465) as server:
-            server.login(EMAIL_ADDRESS, EMAIL_PASSWORD)
+        with _SMTP_LOCK:
+            # повторяем только подключение/логин: обрыв после DATA может
+            # значить, что письмо уже принято, — повтор дал бы дубль
+            server = _retry(get_smtp)
             server.send_message(msg)
+            _SMTP_SENT += 1
         logging.info("✅ Письмо успешно отправлено.")
         return True, None
     except Exception as e:
         logging.info(f"❌ Ошибка при отправке письма: {e}")
         return False, classify_error(e)
 
-# ── Удаление первой строки ────────────────────────────────────────────────────
-def delete_first_row(service):
-    service.spreadsheets().batchUpdate(
-        spreadsheetId=SPREADSHEET_ID,
-        body={
-            'requests': [{
-                'deleteDimension': {
-                    'range': {
-                        'sheetId': SHEET_ID,
-                        'dimension': 'ROWS',
-                        'startIndex': 1,   # удаляем A1
-                        'endIndex': 2
-                    }
+# ── Удаление первых строк ─────────────────────────────────────────────────────
+@functools.lru_cache(maxsize=None)
+def _delete_rows_body(count: int) -> dict:
+    # sheet_id не меняется, а count почти всегда один и тот же — тело собираем
+    # один раз на каждое значение; словарь общий, не изменять
+    return {
+        'requests': [{
+            'deleteDimension': {
+                'range': {
+                    'sheetId': CFG.sheet_id,
+                    'dimension': 'ROWS',
+                    'startIndex': 1,   # удаляем с A2
+                    'endIndex': 1 + count
                 }
-            }]
-        }
-    ).execute()
-    logging.info("♻️ Строка №1 успешно удалена.\n")
+            }
+        }]
+    }
+
+def delete_rows(count: int = 1):
+    """Удаляет count строк, начиная со второй (первая — заголовок)."""
+    # удаление не идемпотентно: после 5xx/обрыва повтор мог бы снести лишние строки
+    req = _BATCH_UPDATE(spreadsheetId=CFG.ss_id, body=_delete_rows_body(count))
+    _retry(req.execute, idempotent=False)
+    logging.info(f"♻️ Удалено строк: {count}.\n")
 
 # ── Одна итерация сценария ────────────────────────────────────────────────────
-def process_once_and_report(chat_id: int):
-    service = build_sheets_service()
-    sheet = service.spreadsheets()
-
-    # Читаем A1:D1 (как ты просил)
-    rng = f"{SHEET_NAME}!A2:D2"
-    res = sheet.values().get(spreadsheetId=SPREADSHEET_ID, range=rng).execute()
-    values = res.get('values', [])
-
-    # Если пусто — сообщаем и всё равно удаляем первую строку
-    if not values or not values[0] or all(cell == "" for cell in values[0]):
-        tg_send(chat_id, "ℹ️ Очередь пуста: в таблице нет строк для отправки.")
-        delete_first_row(service)
+# Очередь писем в таблице одна, поэтому «прочитать строки, отправить,
+# удалить» делает только один воркер за раз (SMTP всё равно общий).
+# Заодно под этим же локом — все вызовы Sheets: googleapiclient/httplib2
+# не потокобезопасны.
+_ROW_LOCK = threading.Lock()
+# Взята строка с задержкой и ждёт отправки: новые триггеры строк не берут,
+# иначе следующие письма ушли бы раньше неё. Меняется только под _ROW_LOCK.
+_DELAYED_PENDING = False
+
+_REPORT_TMPL = (
+    "✉️ Письмо отправлено с аккаунта: {addr}\n"
+    "На адрес: {to}\n"
+    "Была задержка: {d} секунд\n"
+    "Результат: {r}\n"
+    "{deleted}"
+)
+_DELETED_OK = "♻️Строка успешно удалена."
+_DELETED_FAIL = "⚠️ Строку удалить не удалось — при следующем запуске письмо уйдёт повторно."
+
+def process_once_and_report(chat_id: int, report_empty: bool = True):
+    global _DELAYED_PENDING
+    cfg = CFG
+    sent = []        # (email, delay_seconds, success, err_text, deleted)
+    delayed = None   # первая строка с задержкой — дальше пачку не берём
+    delete_error = None
+    with _ROW_LOCK:
+        if _DELAYED_PENDING:
+            tg_send(chat_id, "⏳ В работе: ждёт отправки письмо с задержкой, "
+                             "остальные строки уйдут после него.")
+            return
+        get_sheets_service()
+
+        # Читаем до batch_rows строк одним запросом вместо чтения на
+        # каждое письмо.
+        # Чтение и удаление — два разных запроса намеренно: batchUpdate с
+        # includeSpreadsheetInResponse отдаёт таблицу уже ПОСЛЕ удаления.
+        rng = f"{cfg.sheet_name}!A2:D{cfg.batch_rows + 1}"
+        res = _retry(_VALUES_GET(spreadsheetId=cfg.ss_id, range=rng).execute)
+        values = res.get('values', [])
+
+        # При пустой очереди всё равно удаляем одну строку, как раньше
+        if not values:
+            delete_rows(1)
+
+        # Письма без задержки шлём прямо здесь, и каждую строку удаляем
+        # сразу после её отправки (вместе с пустыми строками перед ней):
+        # сбой посреди пачки повторит максимум одно письмо. Строку с
+        # задержкой забираем одну, остальные ждут её отправки.
+        claimed = 0
+        pending = 0  # прочитаны, но ещё не удалены
+        for row in values:
+            claimed += 1
+            pending += 1
+            # пустая строка ячейки — falsy, так что any() отсеивает пустые строки
+            if not any(row):
+                continue
+            email, subject, html, delay_seconds = parse_row(row)
+            if delay_seconds > 0:
+                try:
+                    delete_rows(pending)
+                    delayed = (email, subject, html, delay_seconds)
+                    _DELAYED_PENDING = True
+                except Exception as e:
+                    delete_error = e
+                break
+            success, err_text = send_email(email, subject, html)
+            try:
+                delete_rows(pending)
+                pending = 0
+            except Exception as e:
+                delete_error = e
+            sent.append((email, delay_seconds, success, err_text, delete_error is None))
+            if delete_error is not None:
+                break
+
+    # Если пусто — сообщаем (строка уже удалена)
+    if not sent and delayed is None and delete_error is None:
+        if report_empty:
+            tg_send(chat_id, "ℹ️ Очередь пуста: в таблице нет строк для отправки.")
+        return
+
+    for email, delay_seconds, success, err_text, deleted in sent:
+        report(chat_id, email, delay_seconds, success, err_text, deleted)
+    if delete_error is not None:
+        logging.info(f"🚨 Ошибка удаления строки: {delete_error}")
+        tg_send(chat_id, f"❌ Ошибка удаления строки: {delete_error}\nОбработка пачки остановлена.")
         return
 
-    row = values[0]
-    email   = row[0] if len(row) > 0 else ""
+    # Письмо с задержкой не спит в воркере, а ставится в планировщик;
+    # оставшиеся строки пачки забираются после его отправки
+    if delayed is not None:
+        email, subject, html, delay_seconds = delayed
+        logging.info(f"⏳ Письмо на {email} запланировано через {delay_seconds} секунд.")
+        _schedule(delay_seconds, send_delayed, chat_id, email, subject, html,
+                  delay_seconds, claimed < len(values))
+
+def parse_row(row: list):
+    email   = row[0].strip() if len(row) > 0 else ""
     subject = row[1] if len(row) > 1 else ""
     html    = row[2] if len(row) > 2 else ""
     delay   = row[3] if len(row) > 3 else "0"
 
-    # Задержка (если указана)
-    try:
-        delay_seconds = int(str(delay).strip())
-    except:
+    # Задержка (если указана); всё, что не целое неотрицательное, — 0
+    if isinstance(delay, int):
+        delay_seconds = delay
+    elif isinstance(delay, str):
+        d = delay.strip()
+        delay_seconds = int(d) if d.isdecimal() else 0
+    else:
         delay_seconds = 0
-    if delay_seconds > 0:
-        logging.info(f"⏳ Ожидание задержки в {delay_seconds} секунд перед отправкой.")
-        time.sleep(delay_seconds)
+    return email, subject, html, delay_seconds
+
+def report(chat_id: int, email: str, delay_seconds: int, success: bool, err_text,
+           deleted: bool = True):
+    # Отчёт в Telegram
+    result = "✅ Успешно отправлено!" if success else f"❌ Ошибка: {err_text}"
+    text = _REPORT_TMPL.format(addr=CFG.email, to=email, d=delay_seconds, r=result,
+                               deleted=_DELETED_OK if deleted else _DELETED_FAIL)
+    tg_send(chat_id, text)
 
-    # Письмо
-    success, err_text = send_email(email, subject, html)
+def send_delayed(chat_id: int, email: str, subject: str, html: str,
+                 delay_seconds: int, more: bool):
+    global _DELAYED_PENDING
+    try:
+        # Письмо
+        success, err_text = send_email(email, subject, html)
+        report(chat_id, email, delay_seconds, success, err_text)
+    finally:
+        with _ROW_LOCK:
+            _DELAYED_PENDING = False
 
-    # Удаляем первую строку в любом случае
-    delete_first_row(service)
+    # Пачка не дочитана — продолжаем тем же порядком, через очередь
+    if more:
+        try:
+            _JOBS.put_nowait((chat_id, False))
+        except queue.Full:
+            logging.info("⚠️ Очередь заданий переполнена, остаток пачки — до следующего триггера.")
 
-    # Отчёт в Telegram
-    if success:
-        report = (
-            f"✉️ Письмо отправлено с аккаунта: {EMAIL_ADDRESS}\n"
-            f"На адрес: {email}\n"
-            f"Была задержка: {delay_seconds} секунд\n"
-            f"Результат: ✅ Успешно отправлено!\n"
-            f"♻️Строка успешно удалена."
-        )
-    else:
-        report = (
-            f"✉️ Письмо отправлено с аккаунта: {EMAIL_ADDRESS}\n"
-            f"На адрес: {email}\n"
-            f"Была задержка: {delay_seconds} секунд\n"
-            f"Результат: ❌ Ошибка: {err_text}\n"
-            f"♻️Строка успешно удалена."
-        )
-    tg_send(chat_id, report)
+# ── Отложенная отправка ───────────────────────────────────────────────────────
+# Один поток-планировщик на монотонных часах. Ожидание — на Event, чтобы
+# новое более раннее задание будило его, а не ждало уже начатый sleep.
+_SCHED_WAKE = threading.Event()
+
+def _sched_delay(timeout):
+    _SCHED_WAKE.wait(timeout)
+    _SCHED_WAKE.clear()
+
+_SCHED = sched.scheduler(time.monotonic, _sched_delay)
+
+def _schedule(delay: float, fn, *args):
+    _SCHED.enter(delay, 1, _run_scheduled, argument=(fn, args))
+    _SCHED_WAKE.set()
+
+def _run_scheduled(fn, args):
+    try:
+        fn(*args)
+    except Exception as e:
+        logging.info(f"🚨 Ошибка отложенной отправки: {e}")
+
+def _sched_loop():
+    while True:
+        _SCHED.run()
+        _sched_delay(None)  # очередь пуста — ждём новых заданий
+
+# ── Воркеры ───────────────────────────────────────────────────────────────────
+# Webhook только кладёт (chat_id, report_empty) в очередь, письма шлют
+# воркеры — долгая задержка или SMTP не держат HTTP-ответ Telegram'у
+JOBS_MAXSIZE = 64
+JOBS_WORKERS = 2
+
+_JOBS = queue.Queue(maxsize=JOBS_MAXSIZE)
+
+def _worker():
+    while True:
+        chat_id, report_empty = _JOBS.get()
+        try:
+            process_once_and_report(chat_id, report_empty)
+        except Exception as e:
+            logging.info(f"🚨 Общая ошибка обработки: {e}")
+            tg_send(chat_id, f"❌ Общая ошибка обработки: {e}")
+        finally:
+            _JOBS.task_done()
+
+def _start_background():
+    """Потоки и сетевые соединения — только в процессе, который обслуживает запросы."""
+    threading.Thread(target=_smtp_keepalive, name="smtp-keepalive", daemon=True).start()
+    threading.Thread(target=_sched_loop, name="email-scheduler", daemon=True).start()
+    for i in range(JOBS_WORKERS):
+        threading.Thread(target=_worker, name=f"email-worker-{i}", daemon=True).start()
+    if CFG.public_url:
+        # в фоне: post_fork идёт до heartbeat'ов воркера, и долгие повторы
+        # setWebhook превысили бы timeout gunicorn
+        threading.Thread(target=tg_set_webhook, name="tg-set-webhook", daemon=True).start()
+
+# Под gunicorn (__main__) мастер ничего не запускает: потоки, ждущие в
+# _JOBS.get(), и открытые сокеты после fork достались бы воркеру «мёртвыми».
+# Там всё стартует в post_fork; в остальных случаях — сразу при импорте.
+if __name__ != "__main__":
+    _start_background()
 
 # ── HTTP endpoints ─────────────────────────────────────────────────────────────
 @app.get("/health")
@@ -168,27 +524,48 @@ def health():
 def webhook():
     # простой секрет через query: /webhook?token=XXXX
     token = request.args.get("token")
-    if WEBHOOK_TOKEN and token != WEBHOOK_TOKEN:
+    if CFG.webhook_token and token != CFG.webhook_token:
         return jsonify(ok=False, error="Forbidden"), 403
 
     update = request.get_json(silent=True) or {}
-    message = update.get("message") or update.get("edited_message")
+    message = update.get("message")
     if not message:
-        return jsonify(ok=True)  # игнор иных типов апдейтов
+        return jsonify(ok=True)  # игнор иных типов апдейтов (в т.ч. edited_message)
 
     chat_id = message["chat"]["id"]
     logging.info(f"🔔 Триггер из Telegram: chat_id={chat_id}")
 
     try:
-        process_once_and_report(chat_id)
-    except Exception as e:
-        logging.info(f"🚨 Общая ошибка обработки: {e}")
-        tg_send(chat_id, f"❌ Общая ошибка обработки: {e}")
+        _JOBS.put_nowait((chat_id, True))
+    except queue.Full:
+        logging.info("⚠️ Очередь заданий переполнена.")
+        tg_send(chat_id, "⚠️ Очередь заданий переполнена, попробуйте позже.")
 
     return jsonify(ok=True)
 
 # ── Run ───────────────────────────────────────────────────────────────────────
+# gunicorn вместо dev-сервера Werkzeug. Воркер один: очередь заданий и
+# _ROW_LOCK живут в процессе; параллельность — за счёт потоков (gthread).
+class _GunicornServer(BaseApplication):
+    def __init__(self, application, options):
+        self.application = application
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        return self.application
+
 if __name__ == "__main__":
     port = int(os.getenv("PORT", "10000"))
-    app.run(host="0.0.0.0", port=port)
+    _GunicornServer(app, {
+        "bind": f"0.0.0.0:{port}",
+        "worker_class": "gthread",
+        "workers": 1,
+        "threads": int(os.getenv("WEB_THREADS", "16")),
+        "post_fork": lambda server, worker: _start_background(),
+    }).run()
 